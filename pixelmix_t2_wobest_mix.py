@@ -1,13 +1,20 @@
 import os
+import math
 import random
 import logging
+import datetime
 from pathlib import Path
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, Sampler
 from torch.utils.data.dataloader import DataLoader
 from tqdm import tqdm, trange
 import numpy as np
+import kornia.augmentation as K  # GPU augmentation for the aug loss (kornia>=0.7 for extra_args)
+from kornia.constants import DataKey, Resample
 
 import hydra
 from omegaconf import OmegaConf, DictConfig
@@ -19,7 +26,6 @@ from datasets.synthia_Dataset import SYNTHIA_Dataset
 from datasets.idd_dataset import IDDDataSet
 from datasets.vistas_dataset import MapillaryDataSet
 
-from perturbations.augmentations import augment, get_augmentation
 from perturbations.fourier import fourier_mix
 from perturbations.cutmix import cutmix_combine
 from models import get_model
@@ -36,14 +42,150 @@ for i in range(zero_pad):
     palette.append(0)
 
 
-def colorize_mask(mask):
-    # mask: numpy array of the mask
-    new_mask = Image.fromarray(mask.astype(np.uint8)).convert('P')
-    new_mask.putpalette(palette)
+def colorize_mask(mask, palette_lut):
+    # mask: (H, W) label tensor, palette_lut: (256, 3) uint8 tensor on the same device
+    # Labels wrap to uint8 as before (ignore -1 -> 255), then one gather builds the RGB image
+    rgb = palette_lut[mask.to(torch.uint8).long()]
 
-    return new_mask
+    return Image.fromarray(rgb.cpu().numpy(), 'RGB')
 
 
+def get_augmentation():
+    """On-device augmentation; geometric ops are applied jointly to the image and its label maps"""
+    return K.AugmentationSequential(
+        K.RandomAffine(degrees=10, translate=(0.1, 0.1), scale=(0.8, 1.2), shear=5, p=1.0),
+        # Inputs are mean-subtracted BGR on a 0-255 scale, so the noise std is scaled to match
+        K.RandomGaussianNoise(mean=0., std=0.1 * 255, p=0.5),
+        data_keys=['input', 'mask'],
+        # Label maps must be warped with nearest neighbour; bilinear would blend class IDs
+        extra_args={DataKey.MASK: dict(resample=Resample.NEAREST, align_corners=True)})
+
+
+def augment(images, labels, aug):
+    # images: (B, 3, H, W) and labels: list of (B, H, W) long tensors, all on the GPU
+    # Labels are shifted by one so zero padding from the affine maps back to the ignore index
+    masks = torch.stack(labels, dim=1).float() + 1
+    images, masks = aug(images, masks)
+    labels = (masks.round().long() - 1).unbind(dim=1)
+    return images, labels
+
+
+def log_threshold(T):
+    # Probability threshold as a log-probability threshold (T <= 0 keeps every pixel)
+    return math.log(T) if T > 0 else -math.inf
+
+
+@torch.compile
+def pseudo_label(logits, T, fallback):
+    # log p_max = max_logit - logsumexp, so the softmax tensor is never materialized
+    logits = logits.float()
+    maxlogit, argpred = logits.max(dim=1)
+    mask = maxlogit - logits.logsumexp(dim=1) > log_threshold(T)
+    return torch.where(mask, argpred, fallback), mask
+
+
+@torch.compile
+def pseudo_label_aux(logits_1, logits_2, T, fallback):
+    # Main label from head 1, aux label from the averaged heads where either is confident
+    logT = log_threshold(T)
+    logits_1, logits_2 = logits_1.float(), logits_2.float()
+    logZ_1, logZ_2 = logits_1.logsumexp(dim=1), logits_2.logsumexp(dim=1)
+    maxlogit_1, argpred_1 = logits_1.max(dim=1)
+    maxlogit_2 = logits_2.amax(dim=1)
+    argpred_c = torch.logaddexp(logits_1 - logZ_1.unsqueeze(1),
+                                logits_2 - logZ_2.unsqueeze(1)).argmax(dim=1)
+    mask_1 = maxlogit_1 - logZ_1 > logT
+    label_1 = torch.where(mask_1, argpred_1, fallback)
+    label_2 = torch.where(mask_1 | (maxlogit_2 - logZ_2 > logT), argpred_c, fallback)
+    return label_1, label_2
+
+
+class TargetForward(nn.Module):
+    """Binds forward_target so the model is a tensor-only callable for CUDA graph capture"""
+
+    def __init__(self, model, forward_target):
+        super().__init__()
+        self.model = model
+        self.forward_target = forward_target
+
+    def forward(self, x):
+        return self.model(x, forward_target=self.forward_target)
+
+
+class PairedDataset(Dataset):
+    """Source and target training sets behind one loader; indices are (source_idx, target_idx) pairs"""
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+
+    def __len__(self):
+        return min(len(self.source), len(self.target))
+
+    def __getitem__(self, idx):
+        source_idx, target_idx = idx
+        return self.source[source_idx], self.target[target_idx]
+
+
+class PairedSampler(Sampler):
+    """Shuffles source and target independently every epoch and pairs them, sharded across DDP ranks"""
+
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = len(dataset) // num_replicas
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        total = self.num_samples * self.num_replicas
+        source_idx = torch.randperm(len(self.dataset.source), generator=g)[:total].tolist()
+        target_idx = torch.randperm(len(self.dataset.target), generator=g)[:total].tolist()
+        pairs = list(zip(source_idx, target_idx))
+        return iter(pairs[self.rank:total:self.num_replicas])
+
+
+class PrefetchLoader():
+    """Copies the next batch to the GPU on a side stream while the current one is being trained on"""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _apply(self, batch, fn):
+        # Batches are (nested) lists of tensors and non-tensor metadata
+        if torch.is_tensor(batch):
+            return fn(batch)
+        if isinstance(batch, (list, tuple)):
+            return [self._apply(b, fn) for b in batch]
+        return batch
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        batch = None
+        for next_batch in self.loader:
+            with torch.cuda.stream(stream):
+                next_batch = self._apply(next_batch, lambda t: t.to(self.device, non_blocking=True))
+            if batch is not None:
+                yield batch
+            torch.cuda.current_stream().wait_stream(stream)
+            self._apply(next_batch, lambda t: t.record_stream(torch.cuda.current_stream()))
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
 
 class Trainer():
     def __init__(self, cfg, logger, writer):
@@ -54,6 +196,10 @@ class Trainer():
         self.logger = logger
         self.writer = writer
 
+        # Distributed (set up in main when launched with torchrun)
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+
         # Counters
         self.epoch = 0
         self.iter = 0
@@ -63,15 +209,26 @@ class Trainer():
 
         # Metrics
         self.evaluator = Eval(self.cfg.data.num_classes)
+        self.palette_lut = torch.tensor(palette, dtype=torch.uint8, device=self.device).view(-1, 3)
+
+        # cuDNN autotuning (training inputs have a fixed shape) and TF32 math on Ampere+
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
         # Loss
         self.ignore_index = -1
+        self.ignore_tensor = torch.full((1,), self.ignore_index, dtype=torch.long, device=self.device)
         self.loss = nn.CrossEntropyLoss(ignore_index=self.ignore_index)
 
         # Model
         self.model, params = get_model(self.cfg)
-        # self.model = nn.DataParallel(self.model, device_ids=[0])  # TODO: test multi-gpu
-        self.model.to(self.device)
+        if self.distributed:
+            self.model = nn.SyncBatchNorm.convert_sync_batchnorm(self.model)
+        self.model.to(self.device, memory_format=torch.channels_last)
+
+        # CUDA graph of the training forward/backward, captured lazily on the first batch
+        self.graphed_model = None
 
         # Previous model
         self.ref_model0 = copy.deepcopy(self.model)  # reference model for knowledge distillation
@@ -86,18 +243,43 @@ class Trainer():
 
         # EMA
         self.ema = EMA(self.model, self.cfg.ema_decay)
+        self.ema.model.to(self.device)  # once here, not on every validation
+
+        # DDP wraps the model after EMA so that EMA tracks the bare module
+        if self.distributed:
+            # A graph replay bypasses DDP.forward, so the reducer never prepares the allreduce
+            if self.cfg.get('cuda_graph', False):
+                raise NotImplementedError('cuda_graph is not supported with DistributedDataParallel')
+            self.model = DistributedDataParallel(
+                self.model, device_ids=[torch.cuda.current_device()],
+                find_unused_parameters=False, gradient_as_bucket_view=True)
+
+        # Only the last backward of an iteration allreduces; earlier ones accumulate locally
+        if self.cfg.lam_cutmix > 0:
+            self.last_branch = 'cutmix'
+        elif self.cfg.lam_fourier > 0:
+            self.last_branch = 'fourier'
+        elif self.cfg.lam_aug > 0:
+            self.last_branch = 'aug'
+        else:
+            self.last_branch = 'self_train'
 
         # Optimizer
         if self.cfg.opt.kind == "SGD":
             self.optimizer = torch.optim.SGD(
-                params, momentum=self.cfg.opt.momentum, weight_decay=self.cfg.opt.weight_decay)
+                params, momentum=self.cfg.opt.momentum, weight_decay=self.cfg.opt.weight_decay,
+                foreach=True)
         elif self.cfg.opt.kind == "Adam":
             self.optimizer = torch.optim.Adam(params, betas=(
-                0.9, 0.99), weight_decay=self.cfg.opt.weight_decay)
+                0.9, 0.99), weight_decay=self.cfg.opt.weight_decay, fused=True)
         else:
             raise NotImplementedError()
         self.lr_factor = 10
 
+        # Mixed precision: cfg.amp is None, 'fp16' (with loss scaling) or 'bf16'
+        self.amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(self.cfg.get('amp', None))
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16)
+
         # Source
         if self.cfg.data.source.dataset == 'synthia':
             source_train_dataset = SYNTHIA_Dataset(split='train', **self.cfg.data.source.kwargs)
@@ -107,8 +289,6 @@ class Trainer():
             source_val_dataset = GTA5_Dataset(split='val', **self.cfg.data.source.kwargs)
         else:
             raise NotImplementedError()
-        self.source_dataloader = DataLoader(
-            source_train_dataset, shuffle=True, drop_last=True, **self.cfg.data.loader.kwargs)
         self.source_val_dataloader = DataLoader(
             source_val_dataset, shuffle=False, drop_last=False, **self.cfg.data.loader.kwargs)
 
@@ -125,14 +305,28 @@ class Trainer():
 
         else:
             raise NotImplementedError()
-        self.target_dataloader = DataLoader(
-            target_train_dataset, shuffle=True, drop_last=True, **self.cfg.data.loader.kwargs)
         self.target_val_dataloader = DataLoader(
             target_val_dataset, shuffle=False, drop_last=False, **self.cfg.data.loader.kwargs)
 
+        # Train: one loader (one worker pool, one prefetch queue) yields (source, target) batches
+        train_dataset = PairedDataset(source_train_dataset, target_train_dataset)
+        self.train_sampler = PairedSampler(
+            train_dataset, num_replicas=dist.get_world_size() if self.distributed else 1,
+            rank=self.rank, seed=self.cfg.seed)
+        # Each paired sample decodes a source and a target image, so the single pool gets the
+        # workers of both former loaders. Only the training workers persist; validation runs
+        # too rarely to keep its pools alive.
+        train_loader_kwargs = dict(self.cfg.data.loader.kwargs)
+        train_loader_kwargs['num_workers'] = min(
+            2 * train_loader_kwargs.get('num_workers', 0), os.cpu_count() or 1)
+        train_loader_kwargs['persistent_workers'] = train_loader_kwargs['num_workers'] > 0
+        self.train_dataloader = PrefetchLoader(DataLoader(
+            train_dataset, sampler=self.train_sampler, drop_last=True,
+            **train_loader_kwargs), self.device)
+
         # Perturbations
         if self.cfg.lam_aug > 0:
-            self.aug = get_augmentation()
+            self.aug = get_augmentation().to(self.device)
 
     def train(self):
 
@@ -147,11 +341,12 @@ class Trainer():
             self.epoch += 1
 
         # Save final checkpoint
-        self.logger.info("=> The best MIou was {:.3f} at iter {}".format(
-            self.best_MIou, self.best_iter))
-        self.logger.info(
-            "=> Saving the final checkpoint to {}".format('final.pth'))
-        self.save_checkpoint('final.pth')
+        if self.rank == 0:
+            self.logger.info("=> The best MIou was {:.3f} at iter {}".format(
+                self.best_MIou, self.best_iter))
+            self.logger.info(
+                "=> Saving the final checkpoint to {}".format('final.pth'))
+            self.save_checkpoint('final.pth')
 
     def train_one_epoch(self):
 
@@ -163,11 +358,12 @@ class Trainer():
         def unpack(x):
             return (x[0], x[1]) if isinstance(x, tuple) else (x, None)
 
+        # Reshuffle (and reshard) the source/target pairing every epoch
+        self.train_sampler.set_epoch(self.epoch)
+
         # Training loop
-        total = min(len(self.source_dataloader), len(self.target_dataloader))
         for batch_idx, (batch_s, batch_t) in enumerate(tqdm(
-            zip(self.source_dataloader, self.target_dataloader),
-            total=total, desc=f"Epoch {self.epoch + 1}"
+            self.train_dataloader, desc=f"Epoch {self.epoch + 1}"
         )):
         
             self.model.train()
@@ -183,81 +379,85 @@ class Trainer():
             ##########################
             # Source supervised loss #
             ##########################
+            # Both batches are already on the GPU: PrefetchLoader copied them on a side
+            # stream while the previous iteration's forward/backward passes were running
             x,y, _ = batch_s
-            x_source = x.clone().to(self.device) #source image 복사
+            x_source = x #source image 복사
+            x_target = batch_t[0]
 
             if True:  # For VS Code collapsing
 
                 # Data
-                x = x.to(self.device)
+                x = x_source
                 y = y.squeeze(dim=1).to(device=self.device,
                                         dtype=torch.long, non_blocking=True)
 
                 # Fourier mix: source --> target
                 if self.cfg.source_fourier:
-                    x = fourier_mix(src_images=x, tgt_images=batch_t[0].to(
-                        self.device), L=self.cfg.fourier_beta)
+                    x = fourier_mix(src_images=x, tgt_images=x_target, L=self.cfg.fourier_beta)
 
-                # Forward
-                pred = self.model(x, forward_target=self.cfg.num_target)
-                pred_1, pred_2 = unpack(pred)
+                with self.autocast():
+                    # Forward
+                    pred = self.forward_train(x, sync=False)
+                    pred_1, pred_2 = unpack(pred)
 
-                # Loss (source)
-                loss_source_1 = self.loss(pred_1, y)
-                if self.cfg.aux:
-                    loss_source_2 = self.loss(pred_2, y) * self.cfg.lam_aux
-                    loss_source = loss_source_1 + loss_source_2
-                else:
-                    loss_source = loss_source_1
+                    # Loss (source)
+                    loss_source_1 = self.loss(pred_1, y)
+                    if self.cfg.aux:
+                        loss_source_2 = self.loss(pred_2, y) * self.cfg.lam_aux
+                        loss_source = loss_source_1 + loss_source_2
+                    else:
+                        loss_source = loss_source_1
 
                 # Backward
-                loss_source.backward()
+                self.scaler.scale(loss_source).backward()
 
                 # Clean up
-                losses['source_main'] = loss_source_1.cpu().item()
+                losses['source_main'] = loss_source_1.detach()
                 if self.cfg.aux:
-                    losses['source_aux'] = loss_source_2.cpu().item()
+                    losses['source_aux'] = loss_source_2.detach()
                 # del x, y, loss_source, loss_source_1, loss_source_2
                 del x, loss_source, loss_source_1, loss_source_2
 
             ######################
             # Target Pseudolabel #
             ######################
-            x, _, _ = batch_t
-            x = x.to(self.device)
+            x = x_target
 
 
             ##############################
             ###        Ours            ###
             ##############################
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 # Pseudo1
-                pseudo_outputs3_1, pseudo_outputs3_2 = self.model(x.to(self.device), forward_target=self.cfg.num_target) # Source + TM3
-  
-                pseudo3_1 = F.softmax(pseudo_outputs3_1, dim=1)
-               
-                label_best = torch.argmax(pseudo3_1.detach(), dim=1)
-                maxpred_best, argpred_best = torch.max(pseudo3_1.detach(), dim=1)
+                pseudo_outputs3_1, pseudo_outputs3_2 = self.forward_train(x) # Source + TM3
 
                 T = self.cfg.pseudobest_threshold
-                mask_1 = (maxpred_best > T)
-                ignore_tensor = torch.ones(1).to(
-                    self.device, dtype=torch.long) * self.ignore_index
 
-                # label_1 = torch.where(mask_1, label_best, ignore_tensor)
-                label_1 = torch.where(mask_1, label_best, y)
+                # label_1, mask_1 = pseudo_label(pseudo_outputs3_1, T, self.ignore_tensor)
+                label_1, mask_1 = pseudo_label(pseudo_outputs3_1, T, y)
+
+                # The pixmatch branch below runs the same model on the same x (no optimizer step
+                # in between), so its pseudo-labels come from these logits too. Derive them now,
+                # before the next forward can reuse the output buffers (cuda_graph).
+                T = self.cfg.pseudolabel_threshold
+                if self.cfg.aux:
+                    label_pm_1, label_pm_2 = pseudo_label_aux(
+                        pseudo_outputs3_1, pseudo_outputs3_2, T, self.ignore_tensor)
+                else:
+                    label_pm_1, _ = pseudo_label(pseudo_outputs3_1, T, self.ignore_tensor)
 
-            mask_1 = mask_1.unsqueeze(0).repeat(1,3,1,1)
-            x_mixed = torch.where(mask_1, x, x_source)
+            x_mixed = torch.where(mask_1.unsqueeze(1), x, x_source)
 
-            pred = self.model(x_mixed.to(self.device), forward_target=self.cfg.num_target)
-            pred_1_g, pred_2_g = unpack(pred)
+            with self.autocast():
+                pred = self.forward_train(x_mixed, sync=self.last_branch == 'self_train')
+                pred_1_g, pred_2_g = unpack(pred)
 
-            loss_self_train1 = self.loss(pred_1_g, label_1) * self.cfg.lam_new
-            loss_self_train2 = self.cfg.lam_aux * self.loss(pred_2_g, label_1) * self.cfg.lam_new
-            loss_self_train = loss_self_train1 + loss_self_train2
+                loss_self_train1 = self.loss(pred_1_g, label_1) * self.cfg.lam_new
+                loss_self_train2 = self.cfg.lam_aux * self.loss(pred_2_g, label_1) * self.cfg.lam_new
+                loss_self_train = loss_self_train1 + loss_self_train2
 
-            loss_self_train.backward()
+            self.scaler.scale(loss_self_train).backward()
             del pred, pred_1_g, pred_2_g, loss_self_train1, loss_self_train2, loss_self_train
 
 
@@ -266,29 +466,10 @@ class Trainer():
             ### original pixmatch ###
             #########################
 
-            # First step: run non-augmented image though model to get predictions
-            with torch.no_grad():
-
-                # Substep 1: forward pass
-                pred = self.model(x.to(self.device), forward_target=self.cfg.num_target)
-                pred_1, pred_2 = unpack(pred)
-
-                # Substep 2: convert soft predictions to hard predictions
-                pred_P_1 = F.softmax(pred_1, dim=1)
-                label_1 = torch.argmax(pred_P_1.detach(), dim=1)
-                maxpred_1, argpred_1 = torch.max(pred_P_1.detach(), dim=1)
-                T = self.cfg.pseudolabel_threshold
-                mask_1 = (maxpred_1 > T)
-                ignore_tensor = torch.ones(1).to(
-                    self.device, dtype=torch.long) * self.ignore_index
-                label_1 = torch.where(mask_1, label_1, ignore_tensor)
-                if self.cfg.aux:
-                    pred_P_2 = F.softmax(pred_2, dim=1)
-                    maxpred_2, argpred_2 = torch.max(pred_P_2.detach(), dim=1)
-                    pred_c = (pred_P_1 + pred_P_2) / 2
-                    maxpred_c, argpred_c = torch.max(pred_c, dim=1)
-                    mask = (maxpred_1 > T) | (maxpred_2 > T)
-                    label_2 = torch.where(mask, argpred_c, ignore_tensor)
+            # First step: hard predictions on the non-augmented image (from the "Ours" forward pass)
+            label_1 = label_pm_1
+            if self.cfg.aux:
+                label_2 = label_pm_2
 
             ############
             # Aug loss #
@@ -296,35 +477,34 @@ class Trainer():
             if self.cfg.lam_aug > 0:
 
                 # Second step: augment image and label
-                x_aug, y_aug_1 = augment(
-                    images=x.cpu(), labels=label_1.detach().cpu(), aug=self.aug)
-                y_aug_1 = y_aug_1.to(device=self.device, non_blocking=True)
-                if self.cfg.aux:
-                    _, y_aug_2 = augment(
-                        images=x.cpu(), labels=label_2.detach().cpu(), aug=self.aug)
-                    y_aug_2 = y_aug_2.to(device=self.device, non_blocking=True)
-
-                # Third step: run augmented image through model to get predictions
-                pred_aug = self.model(x_aug.to(self.device), forward_target=self.cfg.num_target)
-                pred_aug_1, pred_aug_2 = unpack(pred_aug)
-
-                # Fourth step: calculate loss
-                loss_aug_1 = self.loss(pred_aug_1, y_aug_1) * \
-                    self.cfg.lam_aug
                 if self.cfg.aux:
-                    loss_aug_2 = self.loss(pred_aug_2, y_aug_2) * \
-                        self.cfg.lam_aug * self.cfg.lam_aux
-                    loss_aug = loss_aug_1 + loss_aug_2
+                    x_aug, (y_aug_1, y_aug_2) = augment(
+                        images=x, labels=[label_1, label_2], aug=self.aug)
                 else:
-                    loss_aug = loss_aug_1
+                    x_aug, (y_aug_1,) = augment(images=x, labels=[label_1], aug=self.aug)
+
+                with self.autocast():
+                    # Third step: run augmented image through model to get predictions
+                    pred_aug = self.forward_train(x_aug, sync=self.last_branch == 'aug')
+                    pred_aug_1, pred_aug_2 = unpack(pred_aug)
+
+                    # Fourth step: calculate loss
+                    loss_aug_1 = self.loss(pred_aug_1, y_aug_1) * \
+                        self.cfg.lam_aug
+                    if self.cfg.aux:
+                        loss_aug_2 = self.loss(pred_aug_2, y_aug_2) * \
+                            self.cfg.lam_aug * self.cfg.lam_aux
+                        loss_aug = loss_aug_1 + loss_aug_2
+                    else:
+                        loss_aug = loss_aug_1
 
                 # Backward
-                loss_aug.backward()
+                self.scaler.scale(loss_aug).backward()
 
                 # Clean up
-                losses['aug_main'] = loss_aug_1.cpu().item()
+                losses['aug_main'] = loss_aug_1.detach()
                 if self.cfg.aux:
-                    losses['aug_aux'] = loss_aug_2.cpu().item()
+                    losses['aug_aux'] = loss_aug_2.detach()
                 del pred_aug, pred_aug_1, pred_aug_2, loss_aug, loss_aug_1, loss_aug_2
 
             ################
@@ -334,32 +514,33 @@ class Trainer():
 
                 # Second step: fourier mix
                 x_fourier = fourier_mix(
-                    src_images=x.to(self.device),
-                    tgt_images=batch_s[0].to(self.device),
+                    src_images=x,
+                    tgt_images=x_source,
                     L=self.cfg.fourier_beta)
 
-                # Third step: run mixed image through model to get predictions
-                pred_fourier = self.model(x_fourier.to(self.device), forward_target=self.cfg.num_target)
-                pred_fourier_1, pred_fourier_2 = unpack(pred_fourier)
+                with self.autocast():
+                    # Third step: run mixed image through model to get predictions
+                    pred_fourier = self.forward_train(x_fourier, sync=self.last_branch == 'fourier')
+                    pred_fourier_1, pred_fourier_2 = unpack(pred_fourier)
 
-                # Fourth step: calculate loss
-                loss_fourier_1 = self.loss(pred_fourier_1, label_1) * \
-                    self.cfg.lam_fourier
+                    # Fourth step: calculate loss
+                    loss_fourier_1 = self.loss(pred_fourier_1, label_1) * \
+                        self.cfg.lam_fourier
 
-                if self.cfg.aux:
-                    loss_fourier_2 = self.loss(pred_fourier_2, label_2) * \
-                        self.cfg.lam_fourier * self.cfg.lam_aux
-                    loss_fourier = loss_fourier_1 + loss_fourier_2
-                else:
-                    loss_fourier = loss_fourier_1
+                    if self.cfg.aux:
+                        loss_fourier_2 = self.loss(pred_fourier_2, label_2) * \
+                            self.cfg.lam_fourier * self.cfg.lam_aux
+                        loss_fourier = loss_fourier_1 + loss_fourier_2
+                    else:
+                        loss_fourier = loss_fourier_1
 
                 # Backward
-                loss_fourier.backward()
+                self.scaler.scale(loss_fourier).backward()
 
                 # Clean up
-                losses['fourier_main'] = loss_fourier_1.cpu().item()
+                losses['fourier_main'] = loss_fourier_1.detach()
                 if self.cfg.aux:
-                    losses['fourier_aux'] = loss_fourier_2.cpu().item()
+                    losses['fourier_aux'] = loss_fourier_2.detach()
                 del pred_fourier, pred_fourier_1, pred_fourier_2, loss_fourier, loss_fourier_1, loss_fourier_2
 
             ###############
@@ -371,31 +552,32 @@ class Trainer():
                 x_cutmix, y_cutmix = cutmix_combine(
                     images_1=x,
                     labels_1=label_1.unsqueeze(dim=1),
-                    images_2=batch_s[0].to(self.device),
-                    labels_2=batch_s[1].unsqueeze(dim=1).to(self.device, dtype=torch.long))
+                    images_2=x_source,
+                    labels_2=y.unsqueeze(dim=1))
                 y_cutmix = y_cutmix.squeeze(dim=1)
 
-                # Third step: run mixed image through model to get predictions
-                pred_cutmix = self.model(x_cutmix, forward_target=self.cfg.num_target)
-                pred_cutmix_1, pred_cutmix_2 = unpack(pred_cutmix)
-
-                # Fourth step: calculate loss
-                loss_cutmix_1 = self.loss(pred_cutmix_1, y_cutmix) * \
-                    self.cfg.lam_cutmix
-                if self.cfg.aux:
-                    loss_cutmix_2 = self.loss(pred_cutmix_2, y_cutmix) * \
-                        self.cfg.lam_cutmix * self.cfg.lam_aux
-                    loss_cutmix = loss_cutmix_1 + loss_cutmix_2
-                else:
-                    loss_cutmix = loss_cutmix_1
+                with self.autocast():
+                    # Third step: run mixed image through model to get predictions
+                    pred_cutmix = self.forward_train(x_cutmix, sync=self.last_branch == 'cutmix')
+                    pred_cutmix_1, pred_cutmix_2 = unpack(pred_cutmix)
+
+                    # Fourth step: calculate loss
+                    loss_cutmix_1 = self.loss(pred_cutmix_1, y_cutmix) * \
+                        self.cfg.lam_cutmix
+                    if self.cfg.aux:
+                        loss_cutmix_2 = self.loss(pred_cutmix_2, y_cutmix) * \
+                            self.cfg.lam_cutmix * self.cfg.lam_aux
+                        loss_cutmix = loss_cutmix_1 + loss_cutmix_2
+                    else:
+                        loss_cutmix = loss_cutmix_1
 
                 # Backward
-                loss_cutmix.backward()
+                self.scaler.scale(loss_cutmix).backward()
 
                 # Clean up
-                losses['cutmix_main'] = loss_cutmix_1.cpu().item()
+                losses['cutmix_main'] = loss_cutmix_1.detach()
                 if self.cfg.aux:
-                    losses['cutmix_aux'] = loss_cutmix_2.cpu().item()
+                    losses['cutmix_aux'] = loss_cutmix_2.detach()
                 del pred_cutmix, pred_cutmix_1, pred_cutmix_2, loss_cutmix, loss_cutmix_1, loss_cutmix_2
 
             ###############
@@ -403,21 +585,20 @@ class Trainer():
             ###############
 
             # Step optimizer if accumulated enough gradients
-            self.optimizer.step()
-            self.optimizer.zero_grad()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            # Graph replays need the .grad tensors to persist (see forward_train)
+            self.optimizer.zero_grad(set_to_none=not self.cfg.get('cuda_graph', False))
 
             # Update model EMA parameters each step
             self.ema.update_params()
 
-            # Calculate total loss
-            total_loss = sum(losses.values())
-
-            # Log main losses
-            for name, loss in losses.items():
-                self.writer.add_scalar(f'train/{name}', loss, self.iter)
-
-            # Log
+            # Log main losses (kept on the GPU between logs; one D2H copy per log)
             if batch_idx % 100 == 0:
+                losses = dict(zip(losses.keys(), torch.stack(list(losses.values())).tolist()))
+                for name, loss in losses.items():
+                    self.writer.add_scalar(f'train/{name}', loss, self.iter)
+
                 log_string = f"[Epoch {self.epoch}]\t"
                 log_string += '\t'.join([f'{n}: {l:.3f}' for n, l in losses.items()])
                 self.logger.info(log_string)
@@ -434,11 +615,10 @@ class Trainer():
             # After each epoch, update model EMA buffers (i.e. batch norm stats)
             self.ema.update_buffer()
             ######### Validation ##############
-            if batch_idx>0 and batch_idx%200==0:
+            if batch_idx>0 and batch_idx%200==0 and self.rank == 0:
                 # Use EMA params to evaluate performance
                 self.ema.apply_shadow() # save current model to backup & validate with shadow
                 self.ema.model.eval()
-                self.ema.model.cuda()
 
                 # Validate on source (if possible) and target
                 # if self.cfg.data.source_val_iterations > 0:
@@ -470,18 +650,78 @@ class Trainer():
                         self.best_MIou, self.best_iter))
 
 
+    def autocast(self):
+        """Autocast context for the training forward/loss regions; a no-op unless cfg.amp is set"""
+        # The autocast weight cache cannot be used while capturing a CUDA graph
+        return torch.autocast('cuda', dtype=self.amp_dtype or torch.float16,
+                              enabled=self.amp_dtype is not None,
+                              cache_enabled=not self.cfg.get('cuda_graph', False))
+
+    def forward_train(self, x, sync=True):
+        """Training forward pass, replayed from a captured CUDA graph if cfg.cuda_graph"""
+        x = x.contiguous(memory_format=torch.channels_last)
+
+        # DDP decides at forward time whether the following backward allreduces
+        if self.distributed and not sync:
+            with self.model.no_sync():
+                return self.model(x, forward_target=self.cfg.num_target)
+        if not self.cfg.get('cuda_graph', False):
+            return self.model(x, forward_target=self.cfg.num_target)
+
+        # Every branch feeds the same (B, 3, H, W) shape (drop_last=True), so one
+        # forward/backward graph pair is shared by source, self-train, aug, fourier
+        # and cutmix. make_graphed_callables does the side-stream warmup itself.
+        # Capture with grad enabled even if the first call is a no_grad pseudo-label pass,
+        # otherwise no backward graph is recorded.
+        if self.graphed_model is None:
+            # The backward replay hands out its static buffers as gradients. A .grad that is None
+            # would adopt such a buffer, and the next branch's replay would overwrite it, so every
+            # trainable param keeps a real .grad that the replays accumulate into (see zero_grad).
+            for p in self.model.parameters():
+                if p.requires_grad and p.grad is None:
+                    p.grad = torch.zeros_like(p)
+            with torch.enable_grad():
+                self.graphed_model = torch.cuda.make_graphed_callables(
+                    TargetForward(self.model, self.cfg.num_target), (x,))
+            self.check_cuda_graph(x)
+        return self.graphed_model(x)
+
+    def check_cuda_graph(self, x):
+        """Checks on the GPU that graph replays accumulate the same gradients as eager passes"""
+        names, params = zip(*[(n, p) for n, p in self.model.named_parameters() if p.requires_grad])
+        state = {k: v.clone() for k, v in self.model.state_dict().items()}
+        saved_grads = [p.grad.clone() for p in params]
+
+        # Two backward passes on different inputs, as the training branches do
+        grads = []
+        for forward in (lambda inp: self.model(inp, forward_target=self.cfg.num_target),
+                        self.graphed_model):
+            self.model.load_state_dict(state)  # in-place, so BN stats match for both runs
+            for p in params:
+                p.grad.zero_()
+            with torch.enable_grad():
+                for x_ in (x, x.flip(dims=[-1]).contiguous(memory_format=torch.channels_last)):
+                    out = forward(x_)
+                    out = out if isinstance(out, tuple) else (out,)
+                    sum(o.float().mean() for o in out).backward()
+            grads.append([p.grad.clone() for p in params])
+
+        # Leave the model and its gradients as they were
+        self.model.load_state_dict(state)
+        for p, g in zip(params, saved_grads):
+            p.grad.copy_(g)
+
+        for name, g_eager, g_graph in zip(names, *grads):
+            if not torch.allclose(g_eager, g_graph, rtol=1e-3, atol=1e-5):
+                raise RuntimeError(f'cuda_graph gradients differ from eager ones for {name}')
+        self.logger.info('=> CUDA graph gradients match the eager ones')
+
     def save_image(self,pred,gt,idx):
-        pseudo_ = gt[0].unsqueeze(0)
-        pseudo_ = pseudo_.detach().cpu().numpy()
-        pseudo_ = np.asarray(pseudo_, dtype=np.uint8).squeeze(0)
-        output_col = colorize_mask(pseudo_)
+        output_col = colorize_mask(gt[0].detach(), self.palette_lut)
         output_col.save('/data/seunan/CUDA_PixelMix/image/target_%s_%s_color_gt.png' % (self.cfg.num_target,idx))
 
         pred=torch.argmax(pred.detach(),dim=1)
-        pseudo_ = pred[0].unsqueeze(0)
-        pseudo_ = pseudo_.detach().cpu().numpy()
-        pseudo_ = np.asarray(pseudo_, dtype=np.uint8).squeeze(0)
-        output_col = colorize_mask(pseudo_)
+        output_col = colorize_mask(pred[0], self.palette_lut)
         output_col.save('/data/seunan/CUDA_PixelMix/image/target_%s_%s_pred.png' % (self.cfg.num_target,idx))
         
 
@@ -495,6 +735,9 @@ class Trainer():
         self.evaluator.reset()
         self.model.eval()
 
+        # Only rank 0 validates, so bypass DDP and its collectives
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+
         # Select dataloader
         if mode == 'target':
             val_loader = self.target_val_dataloader
@@ -503,27 +746,38 @@ class Trainer():
         else:
             raise NotImplementedError()
 
+        # Confusion matrix accumulated on the GPU (rows: label, cols: prediction); the extra
+        # last bin collects ignored pixels, so no boolean indexing is needed
+        num_classes = self.cfg.data.num_classes
+        confusion = torch.zeros(num_classes ** 2 + 1, dtype=torch.long, device=self.device)
+
         # Loop
         for val_idx, (x, y, id) in enumerate(tqdm(val_loader, desc=f"Val Epoch {self.epoch + 1}")):
             if mode == 'source' and val_idx >= self.cfg.data.source_val_iterations:
                 break
 
             # Forward
-            x = x.to(self.device)
+            x = x.to(self.device, memory_format=torch.channels_last)
             y = y.to(device=self.device, dtype=torch.long)
-            pred = self.model(x, forward_target=self.cfg.num_target)
+            pred = model(x, forward_target=self.cfg.num_target)
             if isinstance(pred, tuple):
                 pred = pred[0]
 
-            # Convert to numpy
-            label = y.squeeze(dim=1).cpu().numpy()
-            argpred = np.argmax(pred.data.cpu().numpy(), axis=1)
+            label = y.squeeze(dim=1)
+            argpred = pred.argmax(dim=1)
             if val_idx>0 and val_idx%300==0:
                 self.save_image(pred,y,val_idx)
-            # Add to evaluator
-            self.evaluator.add_batch(label, argpred)
+            # Add to confusion matrix
+            valid = (label >= 0) & (label < num_classes)
+            idx = torch.where(valid, num_classes * label + argpred, num_classes ** 2)
+            confusion += torch.bincount(idx.flatten(), minlength=num_classes ** 2 + 1)
+
+        # Add to evaluator (a single copy back per validation)
+        self.evaluator.confusion_matrix += confusion[:-1].view(
+            num_classes, num_classes).cpu().numpy()
 
         # Tensorboard images
+        label, argpred = label.cpu().numpy(), argpred.cpu().numpy()
         vis_imgs = 2
         images_inv = inv_preprocess(x.clone().cpu(), vis_imgs, numpy_transform=True)
         labels_colors = decode_labels(label, vis_imgs)
@@ -594,7 +848,7 @@ class Trainer():
 
         # Load state dict
         if hasattr(self.model, 'module'):
-            self.model.module.load_state_dict(state_dict)
+            self.model.module.load_state_dict(state_dict, strict=False)
         else:
             # for k,v in self.model.named_parameters():
             #     if 'layer1.0.conv1.weight' in k:
@@ -632,6 +886,16 @@ class Trainer():
 @hydra.main(config_path='configs', config_name='gta5')
 def main(cfg: DictConfig):
 
+    # Distributed: torchrun --nproc_per_node=N sets WORLD_SIZE and LOCAL_RANK
+    rank = 0
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        # Only rank 0 validates while the other ranks wait in their next collective, so the
+        # timeout has to cover a full validation (plus image dumps), not the NCCL default
+        dist.init_process_group(backend='nccl', timeout=datetime.timedelta(
+            minutes=cfg.get('dist_timeout_min', 120)))
+        torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
+        rank = dist.get_rank()
+
     # Seeds
     random.seed(cfg.seed)
     np.random.seed(cfg.seed)
@@ -645,7 +909,7 @@ def main(cfg: DictConfig):
     # if cfg.wandb:
     #     import wandb
     #     wandb.init(project='pixmatch', name=cfg.name, config=cfg, sync_tensorboard=True)
-    writer = SummaryWriter(cfg.name)
+    writer = SummaryWriter(cfg.name if rank == 0 else os.path.join(cfg.name, f'rank{rank}'))
 
     # Trainer
     trainer = Trainer(cfg=cfg, logger=logger, writer=writer)